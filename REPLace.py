@@ -1,14 +1,20 @@
+import io
 import os
 import sys
 import time
 import re
+import base64
+import binascii
+import struct
 import serial
-import shutil
 import logging
-import tempfile
+import tokenize
 import argparse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from operator import attrgetter
 from pathlib import Path
-from typing import Set, List, Optional
+from typing import Deque, Iterator, Set, List, Optional, Tuple, Union
 
 # Configure logging
 logging.basicConfig(
@@ -34,10 +40,53 @@ class Uploader:
     # Configuration constants
     BAUDRATE = 115200
     TIMEOUT = 0.1
-    FILEBLOCKSIZE = 1024
+    FILEBLOCKSIZE = 4096
     MAX_BUFFER = 100000  # bytes
-    COMMAND_WAIT = 0.05  # seconds between commands
-    RECV_TIMEOUT = 5  # seconds for recv operations
+    COMMAND_WAIT = 0.05  # seconds to settle after interrupting device
+    RECV_TIMEOUT = 5  # seconds to wait for device output
+    WRITE_TIMEOUT = 1  # seconds before a stalled write fails
+    BAUDRATE_WAIT = 0.5  # seconds to wait for an answer when switching baud rate
+    BATCH_BYTES = 8192  # max payload bytes per batch (2 full FILEBLOCKSIZE chunks)
+    PREPARE_WORKERS = 4  # threads preparing files while uploading
+
+    # Imports and helpers defined on device after connecting
+    DEVICE_SETUP = (
+        "import os\n"
+        "import ubinascii as _u\n"
+        "def _crc(p):\n"
+        " c=0\n"
+        " try:\n"
+        "  with open(p,'rb') as f:\n"
+        "   while 1:\n"
+        "    b=f.read(1024)\n"
+        "    if not b:return c\n"
+        "    c=_u.crc32(b,c)\n"
+        " except Exception:\n"
+        "  return -1\n"
+    )
+
+    # Chunk write command, wrapped around the base64 payload
+    WRITE_PREFIX = b"outfile.write(_u.a2b_base64(b'"
+    WRITE_SUFFIX = b"'))\n"
+
+    # Raw REPL protocol
+    INTERRUPT = b'\x03\x03'  # Ctrl-C
+    RAW_REPL = b'\r\x01'  # Ctrl-A
+    FRIENDLY_REPL = b'\r\x02'  # Ctrl-B
+    RAW_PASTE = b'\x05A\x01'  # Ctrl-E 'A' Ctrl-A
+    ABORT_PASTE = b'\x03'  # Ctrl-C ends raw-paste without running the code
+    RAW_REPL_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+    PROMPT = b'\x04>'  # end of command output in raw REPL
+    EOT = b'\x04'  # Ctrl-D
+    RAW_BLOCKSIZE = 256  # bytes per write without raw-paste flow control
+    RAW_BLOCK_WAIT = 0.01  # seconds between such writes
+    BAUDRATE_CHANGE = "import machine\nmachine.UART(0,{})"
+
+    # Smashing patterns, used when a file cannot be tokenized
+    _RE_TRAILING = re.compile(r'[ \t\r]+$', re.MULTILINE)
+    _RE_BLANK = re.compile(r'^\n', re.MULTILINE)
+    _RE_FULLCOMMENT = re.compile(r'^[ \t]*#[^\n]*(?:\n|\Z)', re.MULTILINE)
+    _RE_INLINE = re.compile(r'[ \t]*#[^#\n]*$', re.MULTILINE)
 
     def __init__(
             self,
@@ -49,7 +98,8 @@ class Uploader:
             smash_level: int = 2,
             temp_dir: Optional[str] = None,
             dry_run: bool = False,
-            verbose: bool = False
+            verbose: bool = False,
+            baudrate: Optional[int] = None
     ):
         """Initialize uploader with configuration.
 
@@ -60,13 +110,17 @@ class Uploader:
             includes: If set, only these basenames are uploaded
             smash: Remove comments and blank lines from files
             smash_level: 1=blank lines, 2=full comments, 3=inline comments
-            temp_dir: Temporary directory for smashed files
+            temp_dir: Deprecated and ignored; smashed files are kept in memory
             dry_run: Don't actually upload, just show what would happen
             verbose: Print debug information
+            baudrate: Baud rate to switch to after connecting (None = BAUDRATE)
         """
         self.port = port
+        self.baudrate = baudrate or self.BAUDRATE
         self.connection = None
-        self.rbuffer = ''
+        self.rbuffer = bytearray()
+        self.raw_paste: Optional[bool] = None  # None = not probed yet
+        self.pending_output = 0  # commands whose output is not read yet
         self.dry_run = dry_run
         self.verbose = verbose
 
@@ -77,10 +131,8 @@ class Uploader:
         self.file_system_dir = Path(file_system_dir or os.getcwd())
         if not self.file_system_dir.exists():
             raise UploaderException(f"Directory not found: {self.file_system_dir}")
-
-        # Temporary directory
-        self.temp_dir = Path(temp_dir or tempfile.gettempdir())
-        self.temp_dir.mkdir(exist_ok=True)
+        # Absolute root with trailing separator, for slicing off relative paths
+        self._root_str = os.path.join(os.path.abspath(self.file_system_dir), '')
 
         # Exclusions and inclusions
         self.excludes: Set[str] = self._process_list(excludes)
@@ -92,6 +144,7 @@ class Uploader:
 
         # Statistics
         self.files_uploaded = 0
+        self.files_skipped = 0
         self.dirs_created = 0
         self.bytes_sent = 0
 
@@ -118,6 +171,80 @@ class Uploader:
                 f"Cannot access port {self.port}: {e}"
             )
 
+    def _open(self, baudrate: int) -> serial.Serial:
+        """Open serial port.
+
+        Args:
+            baudrate: Baud rate to open the port with
+
+        Returns:
+            Open serial connection
+        """
+        connection = serial.Serial(
+            port=self.port,
+            baudrate=baudrate,
+            timeout=self.RECV_TIMEOUT,
+            write_timeout=self.WRITE_TIMEOUT,
+            parity=serial.PARITY_NONE,
+            stopbits=serial.STOPBITS_ONE,
+            bytesize=serial.EIGHTBITS
+        )
+        connection.flush()
+        return connection
+
+    def _enter_raw_repl(self) -> None:
+        """Interrupt device and switch it to raw REPL."""
+        # Clear any pending input
+        self.connection.write(self.INTERRUPT)
+        time.sleep(self.COMMAND_WAIT)
+        self.connection.reset_input_buffer()
+        self.pending_output = 0
+
+        self.connection.write(self.RAW_REPL)
+        self._read_until(self.RAW_REPL_BANNER)
+
+    def _change_baudrate(self, baudrate: int) -> bool:
+        """Switch device REPL and connection to another baud rate.
+
+        Args:
+            baudrate: New baud rate
+
+        Returns:
+            True if the device answers at the new baud rate, False if the
+            connection stays in raw REPL at the old one
+        """
+        old_baudrate = self.connection.baudrate
+        self._exec(self.BAUDRATE_CHANGE.format(baudrate).encode('utf-8'))
+
+        # A reply readable at the old rate means the device did not switch,
+        # e.g. "UART(0) is disabled" on ESP32
+        self.connection.timeout = self.BAUDRATE_WAIT
+        try:
+            reply = self.connection.read_until(self.PROMPT)
+        finally:
+            self.connection.timeout = self.RECV_TIMEOUT
+        if reply.endswith(self.PROMPT) and self.EOT in reply[:-len(self.PROMPT)]:
+            error = reply[:-len(self.PROMPT)].partition(self.EOT)[2]
+            logger.debug(f"Device kept its baud rate: {error.decode('utf-8', 'replace').strip()}")
+            return False
+
+        self.connection.close()
+        self.connection = self._open(baudrate)
+        self.connection.timeout = self.BAUDRATE_WAIT
+        try:
+            self.connection.write(self.RAW_REPL)
+            self._read_until(self.RAW_REPL_BANNER)
+            return True
+        except SerialConnectionException as e:
+            logger.debug(f"No answer at {baudrate} baud: {e}")
+        finally:
+            self.connection.timeout = self.RECV_TIMEOUT
+
+        self.connection.close()
+        self.connection = self._open(old_baudrate)
+        self._enter_raw_repl()
+        return False
+
     def _connect(self) -> None:
         """Establish serial connection."""
         if self.dry_run:
@@ -126,19 +253,17 @@ class Uploader:
 
         logger.info(f"Connecting to {self.port} at {self.BAUDRATE} baud...")
         try:
-            self.connection = serial.Serial(
-                port=self.port,
-                baudrate=self.BAUDRATE,
-                timeout=self.TIMEOUT,
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE,
-                bytesize=serial.EIGHTBITS
-            )
-            self.connection.flush()
+            self.connection = self._open(self.BAUDRATE)
+            self._enter_raw_repl()
 
-            # Clear any pending input
-            self.connection.write([3, 3])  # Ctrl-C
-            self.recv(done=True)
+            if self.baudrate != self.BAUDRATE:
+                if self._change_baudrate(self.baudrate):
+                    logger.info(f"Switched to {self.baudrate} baud")
+                else:
+                    logger.warning(
+                        f"Could not switch to {self.baudrate} baud, "
+                        f"staying at {self.BAUDRATE}"
+                    )
 
             logger.info("Connected successfully")
         except serial.SerialException as e:
@@ -148,37 +273,235 @@ class Uploader:
         """Close serial connection."""
         if self.connection and not self.dry_run:
             try:
-                self.connection.write([3, 3])  # Ctrl-C
-                self.recv(done=True)
-                self.connection.close()
+                # Leave device at the rate other tools expect, resyncing first
+                # in case an error left a command half-sent
+                if self.connection.baudrate != self.BAUDRATE:
+                    self._enter_raw_repl()
+                    if not self._change_baudrate(self.BAUDRATE):
+                        logger.warning(
+                            f"Could not restore {self.BAUDRATE} baud, "
+                            f"device is still at {self.connection.baudrate}"
+                        )
+
+                self.connection.write(self.INTERRUPT)
+                self.connection.write(self.FRIENDLY_REPL)
+                self._read_until(b'>>> ')
                 logger.info("Disconnected")
             except Exception as e:
                 logger.warning(f"Error during disconnect: {e}")
+            finally:
+                self.connection.close()
 
-    def send(self, line: str = '') -> None:
+    def send(self, line: str = '', quiet: bool = False) -> None:
         """Send command to device.
 
         Args:
             line: Python command to execute on device
+            quiet: Don't wait for the output; it is read before the next
+                command is submitted
         """
         if self.dry_run:
             logger.debug(f"DRY RUN: Would send: {line}")
             return
 
+        self._send_code(line.encode('utf-8'), quiet)
+
+    def _send_code(self, code: bytes, quiet: bool = False) -> None:
+        """Execute encoded Python code on device.
+
+        Args:
+            code: Python source to execute on device
+            quiet: Don't wait for the output (see send)
+        """
         if not self.connection:
             raise SerialConnectionException("Not connected")
 
         try:
-            cmd = line + '\r'
-            self.connection.write([ord(x) for x in cmd])
-            self.bytes_sent += len(cmd)
-            time.sleep(self.COMMAND_WAIT)
+            self._exec(code)
+            self.bytes_sent += len(code)
+            if quiet:
+                self.pending_output += 1
+            else:
+                self.recv()
+        except serial.SerialException as e:
+            raise SerialConnectionException(f"Send failed: {e}")
+
+    def _send_batch(self, commands: List[bytes]) -> None:
+        """Send several commands to device in a single round-trip.
+
+        Args:
+            commands: Encoded Python commands, each ending in a newline
+        """
+        if not commands:
+            return
+
+        if self.dry_run:
+            logger.debug(f"DRY RUN: Would send batch of {len(commands)} commands")
+            return
+
+        self._send_code(b''.join(commands), quiet=True)
+
+    def _read_exact(self, size: int) -> bytes:
+        """Read exactly ``size`` bytes from device.
+
+        Args:
+            size: Number of bytes to read
+
+        Returns:
+            Received bytes
+        """
+        data = self.connection.read(size)
+        if len(data) < size:
+            raise SerialConnectionException(
+                f"Timeout waiting for device (got {data!r})"
+            )
+        return data
+
+    def _read_until(self, ending: bytes) -> bytes:
+        """Read from device until ``ending`` has been received.
+
+        Args:
+            ending: Byte sequence terminating the read
+
+        Returns:
+            Received bytes including ``ending``
+        """
+        data = self.connection.read_until(ending)
+        if not data.endswith(ending):
+            raise SerialConnectionException(
+                f"Timeout waiting for {ending!r} (got {data[-40:]!r})"
+            )
+        return data
+
+    def _enter_raw_paste(self) -> int:
+        """Ask the raw REPL to accept the next command in raw-paste mode.
+
+        Returns:
+            Flow-control window size, or 0 if raw-paste is not supported
+        """
+        self.connection.write(self.RAW_PASTE)
+        # The reply follows the output of commands still running
+        try:
+            self._drain()
+        except UploaderException:
+            self._abort_raw_paste()
+            raise
+        return self._read_raw_paste_reply()
+
+    def _read_raw_paste_reply(self) -> int:
+        """Read the device's answer to RAW_PASTE.
+
+        Returns:
+            Flow-control window size, or 0 if raw-paste is not supported
+        """
+        response = self._read_exact(2)
+        if response == b'R\x01':
+            return struct.unpack('<H', self._read_exact(2))[0]
+        if response != b'R\x00':
+            # Firmware predates raw-paste and treated Ctrl-A as a raw REPL reset
+            self._read_until(self.RAW_REPL_BANNER[2:])
+        return 0
+
+    def _abort_raw_paste(self) -> None:
+        """Consume the answer to RAW_PASTE and leave raw-paste unused.
+
+        Keeps the REPL in sync when a command can't follow the handshake.
+        """
+        try:
+            if self._read_raw_paste_reply():
+                self.connection.write(self.ABORT_PASTE)
+                self._read_until(self.PROMPT)
+        except SerialConnectionException as e:
+            logger.debug(f"Could not abort raw-paste: {e}")
+
+    def _drain(self) -> None:
+        """Read output of commands sent with quiet=True."""
+        while self.pending_output:
+            self.pending_output -= 1
             self.recv()
+
+    def _exec(self, code: bytes) -> None:
+        """Submit code to the raw REPL for execution.
+
+        Uses raw-paste mode with its flow control when the device supports
+        it, otherwise falls back to plain raw REPL input. Output of the
+        command is left for ``recv``.
+
+        Args:
+            code: Python source to execute on device
+        """
+        window = 0
+        if self.raw_paste is not False:
+            window = self._enter_raw_paste()
+            self.raw_paste = window > 0
+
+        if not window:
+            self._drain()
+            for i in range(0, len(code), self.RAW_BLOCKSIZE):
+                self.connection.write(code[i:i + self.RAW_BLOCKSIZE])
+                time.sleep(self.RAW_BLOCK_WAIT)
+            self.connection.write(self.EOT)
+            response = self._read_exact(2)
+            if response != b'OK':
+                raise SerialConnectionException(
+                    f"Raw REPL did not accept command: {response!r}"
+                )
+            return
+
+        remaining = window
+        pos = 0
+        while pos < len(code):
+            # Wait for the device to open the window, collect pending tokens
+            while remaining == 0 or self.connection.in_waiting:
+                token = self._read_exact(1)
+                if token == b'\x01':
+                    remaining += window
+                elif token == self.EOT:
+                    # Device ended the transfer early
+                    self.connection.write(self.EOT)
+                    return
+                else:
+                    raise SerialConnectionException(
+                        f"Unexpected raw-paste flow control: {token!r}"
+                    )
+            block = code[pos:pos + remaining]
+            self.connection.write(block)
+            remaining -= len(block)
+            pos += len(block)
+
+        self.connection.write(self.EOT)
+        self._read_until(self.EOT)
+
+    def _query(self, line: str) -> str:
+        """Execute command on device and return what it printed.
+
+        Args:
+            line: Python command to execute on device
+
+        Returns:
+            Stripped stdout of the command
+        """
+        if not self.connection:
+            raise SerialConnectionException("Not connected")
+
+        try:
+            code = line.encode('utf-8')
+            self._exec(code)
+            self.bytes_sent += len(code)
+            output, _, error = self._read_until(self.PROMPT).partition(self.EOT)
         except serial.SerialException as e:
             raise SerialConnectionException(f"Send failed: {e}")
 
+        error = error[:-len(self.PROMPT)].decode('utf-8', 'replace').strip()
+        if error:
+            raise UploaderException(f"Device error: {error.splitlines()[-1]}")
+        return output.decode('utf-8', 'replace').strip()
+
     def recv(self, done: bool = False) -> None:
-        """Receive data from device.
+        """Receive output of the last command from device.
+
+        Reads until the raw REPL signals the end of execution. Anything
+        the command wrote to stderr is raised as an UploaderException.
 
         Args:
             done: If True, print remaining buffer
@@ -189,83 +512,153 @@ class Uploader:
         if not self.connection:
             return
 
-        start_time = time.time()
-        while time.time() - start_time < self.RECV_TIMEOUT:
-            try:
-                data = self.connection.read(1024)
-                if data:
-                    decoded = data.decode(encoding='utf-8', errors='replace')
-                    self.rbuffer += decoded
-                else:
-                    break
-            except Exception as e:
-                logger.warning(f"Receive error: {e}")
-                break
+        try:
+            data = self.connection.read_until(self.PROMPT, size=self.MAX_BUFFER)
+            if not data.endswith(self.PROMPT) and len(data) < self.MAX_BUFFER:
+                logger.warning("Timeout waiting for command to finish")
+            self.rbuffer.extend(data)
+        except Exception as e:
+            logger.warning(f"Receive error: {e}")
 
-        # Remove carriage returns
-        self.rbuffer = self.rbuffer.replace('\r', '')
+        # Split "stdout<EOT>stderr<EOT>>" into its parts, keeping stdout in place
+        error = ''
+        eot = self.rbuffer.find(self.EOT)
+        if eot >= 0:
+            error = self.rbuffer[eot + 1:-len(self.PROMPT)].decode('utf-8', 'replace').strip()
+            del self.rbuffer[eot:]
+        if error:
+            done = True
 
         # Print complete lines
-        while '\n' in self.rbuffer:
-            idx = self.rbuffer.index('\n')
-            line = self.rbuffer[:idx]
-            self.rbuffer = self.rbuffer[idx + 1:]
-            if line.strip():
-                logger.info(f">> {line}")
+        idx = self.rbuffer.rfind(b'\n')
+        if idx >= 0:
+            for line in self.rbuffer[:idx].split(b'\n'):
+                if line.strip():
+                    text = line.rstrip(b'\r').decode('utf-8', 'replace')
+                    logger.info(f">> {text}")
+            del self.rbuffer[:idx + 1]
 
         # Print remaining buffer if done
         if done and self.rbuffer.strip():
-            logger.info(f">> {self.rbuffer}")
+            text = self.rbuffer.rstrip(b'\r').decode('utf-8', 'replace')
+            logger.info(f">> {text}")
+            self.rbuffer.clear()
 
         # Prevent buffer overflow
         if len(self.rbuffer) > self.MAX_BUFFER:
-            self.rbuffer = self.rbuffer[-self.MAX_BUFFER:]
+            del self.rbuffer[:-self.MAX_BUFFER]
+
+        if error:
+            raise UploaderException(f"Device error: {error.splitlines()[-1]}")
+
+    def _smash_source(self, text: str) -> str:
+        """Remove comments and blank lines from Python source.
+
+        Uses the tokenizer, so '#' characters and blank lines inside string
+        literals are left alone.
+
+        Args:
+            text: Python source code
+
+        Returns:
+            Smashed source code
+        """
+        lines = text.split('\n')
+        code_rows: Set[int] = set()  # rows holding code tokens
+        comment_rows: Set[int] = set()
+        eol_rows: Set[int] = set()  # rows that end a physical line
+        drop: Set[int] = set()
+        cut = {}  # row -> column where an inline comment starts
+
+        for tok in tokenize.generate_tokens(io.StringIO(text).readline):
+            row = tok.start[0]
+            if tok.type == tokenize.COMMENT:
+                comment_rows.add(row)
+                if row in code_rows:
+                    # Remove inline comments (level 3)
+                    if self.smash_level >= 3:
+                        cut[row] = tok.start[1]
+                elif self.smash_level >= 2:
+                    # Skip full comment lines
+                    drop.add(row)
+            elif tok.type in (tokenize.NL, tokenize.NEWLINE):
+                eol_rows.add(row)
+                # Skip blank lines
+                if (self.smash_level >= 1 and
+                        row not in code_rows and row not in comment_rows):
+                    drop.add(row)
+            elif tok.type not in (tokenize.DEDENT, tokenize.ENDMARKER):
+                code_rows.update(range(row, tok.end[0] + 1))
+
+        result = []
+        for row, line in enumerate(lines, start=1):
+            if row in drop:
+                continue
+            line = line[:cut[row]] if row in cut else line.rstrip('\r')
+            if row in eol_rows:
+                line = line.rstrip()
+            result.append(line)
+        return '\n'.join(result)
+
+    def _smash_text(self, text: str) -> str:
+        """Remove comments and blank lines line by line.
+
+        Fallback for files the tokenizer rejects; '#' inside string
+        literals is not recognized.
+
+        Args:
+            text: File contents
+
+        Returns:
+            Smashed file contents
+        """
+        text = self._RE_TRAILING.sub('', text)
+
+        # Skip full comment lines
+        if self.smash_level >= 2:
+            text = self._RE_FULLCOMMENT.sub('', text)
 
-    def _smash_file(self, input_path: Path, output_path: Path) -> None:
+        # Remove inline comments (level 3)
+        if self.smash_level >= 3:
+            text = self._RE_INLINE.sub('', text)
+
+        # Skip blank lines
+        if self.smash_level >= 1:
+            text = self._RE_BLANK.sub('', text)
+
+        return text
+
+    def _smash_file(self, input_path: Path) -> bytes:
         """Remove comments and blank lines from file.
 
         Args:
             input_path: Source file path
-            output_path: Destination file path
+
+        Returns:
+            Smashed file contents
         """
         try:
-            with open(input_path, 'r', encoding='utf-8') as infile:
-                with open(output_path, 'w', encoding='utf-8') as outfile:
-                    for line in infile:
-                        line_stripped = line.strip()
-
-                        # Skip blank lines
-                        if not line_stripped:
-                            if self.smash_level < 1:
-                                outfile.write('\n')
-                            continue
-
-                        # Skip full comment lines
-                        if line_stripped.startswith('#') and self.smash_level >= 2:
-                            continue
-
-                        # Remove inline comments (level 3)
-                        if '#' in line_stripped and self.smash_level >= 3:
-                            cleaned = line.rstrip().rsplit('#', 1)[0].rstrip()
-                            outfile.write(cleaned + '\n')
-                        else:
-                            outfile.write(line.rstrip() + '\n')
+            text = input_path.read_text(encoding='utf-8')
+            try:
+                text = self._smash_source(text)
+            except (tokenize.TokenError, SyntaxError) as e:
+                logger.debug(f"Cannot tokenize {input_path.name} ({e}), smashing by line")
+                text = self._smash_text(text)
 
             logger.debug(f"Smashed: {input_path.name}")
+            return text.encode('utf-8')
         except IOError as e:
             raise UploaderException(f"Cannot smash file {input_path}: {e}")
 
-    def _prepare_file(self, file_path: Path) -> Path:
+    def _prepare_file(self, file_path: Path) -> Union[bytes, Path]:
         """Prepare file for upload (smash if needed).
 
         Args:
             file_path: Source file path
 
         Returns:
-            Path to file ready for upload
+            Smashed contents, or path to file ready for upload
         """
-        temp_file = self.temp_dir / f"smash_{file_path.name}"
-
         # Decide if we should smash
         should_smash = (
                 self.smash and
@@ -273,44 +666,90 @@ class Uploader:
         )
 
         if should_smash:
-            self._smash_file(file_path, temp_file)
-            return temp_file
-        else:
-            shutil.copy2(file_path, temp_file)
-            return temp_file
+            return self._smash_file(file_path)
+
+        # Other files are streamed from their original location
+        return file_path
+
+    def _iter_chunks(self, prepared: Union[bytes, Path]) -> Iterator[bytes]:
+        """Split prepared file into upload chunks.
+
+        Args:
+            prepared: Result of _prepare_file
+
+        Returns:
+            Iterator over chunks of at most FILEBLOCKSIZE bytes
+        """
+        if isinstance(prepared, bytes):
+            view = memoryview(prepared)
+            for i in range(0, len(view), self.FILEBLOCKSIZE):
+                yield view[i:i + self.FILEBLOCKSIZE]
+            return
 
-    def _upload_file(self, local_path: Path, remote_path: str) -> None:
+        with open(prepared, 'rb') as f:
+            while True:
+                data = f.read(self.FILEBLOCKSIZE)
+                if not data:
+                    break
+                yield data
+
+    def _upload_file(
+            self,
+            local_path: Path,
+            remote_path: str,
+            prepared: Union[bytes, Path, Future, None] = None
+    ) -> None:
         """Upload single file to device.
 
         Args:
             local_path: Local file path
             remote_path: Remote path on device (e.g., 'main.py')
+            prepared: Result of _prepare_file, or a future of it (None = prepare now)
         """
         logger.info(f"Uploading: {remote_path}")
 
         try:
             # Prepare file
-            prepared_file = self._prepare_file(local_path)
-            file_size = prepared_file.stat().st_size
+            if prepared is None:
+                prepared = self._prepare_file(local_path)
+            elif isinstance(prepared, Future):
+                prepared = prepared.result()
 
             if self.dry_run:
                 logger.info(f"DRY RUN: Would upload {local_path} to {remote_path}")
                 return
 
+            # Skip files whose content is already on device
+            local_crc = 0
+            for data in self._iter_chunks(prepared):
+                local_crc = binascii.crc32(data, local_crc)
+            if self._query(f"print(_crc('{remote_path}'))") == str(local_crc):
+                self.files_skipped += 1
+                logger.info(f"= {remote_path} (unchanged)")
+                return
+
             # Open file on device
             self.send(f"outfile=open('{remote_path}',mode='wb')")
 
-            # Send file in chunks
-            with open(prepared_file, 'rb') as f:
-                chunk_num = 0
-                while True:
-                    data = f.read(self.FILEBLOCKSIZE)
-                    if not data:
-                        break
-                    self.send(f"outfile.write({data})")
-                    chunk_num += 1
-                    if self.verbose and chunk_num % 10 == 0:
-                        logger.debug(f"  {chunk_num} chunks sent...")
+            # Send file in chunks, several chunks per round-trip
+            chunk_num = 0
+            file_size = 0
+            batch: List[bytes] = []
+            batch_bytes = 0
+            for data in self._iter_chunks(prepared):
+                batch.append(
+                    self.WRITE_PREFIX + base64.b64encode(data) + self.WRITE_SUFFIX
+                )
+                batch_bytes += len(data)
+                file_size += len(data)
+                chunk_num += 1
+                if batch_bytes >= self.BATCH_BYTES:
+                    self._send_batch(batch)
+                    batch = []
+                    batch_bytes = 0
+                if self.verbose and chunk_num % 10 == 0:
+                    logger.debug(f"  {chunk_num} chunks sent...")
+            self._send_batch(batch)
 
             # Close file
             self.send("outfile.close()")
@@ -322,31 +761,54 @@ class Uploader:
             logger.error(f"Failed to upload {remote_path}: {e}")
             raise
 
-    def _create_directory(self, dir_path: str) -> None:
-        """Create directory on device.
+    def _create_directories(self, dir_paths: List[str]) -> None:
+        """Create directories on device with a single command.
 
         Args:
-            dir_path: Directory path on device
+            dir_paths: Directory paths on device, parents before children
         """
-        parent = str(Path(dir_path).parent) if dir_path != '/' else ''
-        basename = Path(dir_path).name
+        if not dir_paths:
+            return
 
         if self.dry_run:
-            logger.info(f"DRY RUN: Would create directory {dir_path}")
+            for dir_path in dir_paths:
+                logger.info(f"DRY RUN: Would create directory {dir_path}")
             return
 
         try:
-            if parent:
-                cmd = f"if '{basename}' not in os.listdir('{parent}'): os.mkdir('{parent}/{basename}')"
-                logger.debug(f"Creating: {dir_path}")
-            else:
-                cmd = f"if '{basename}' not in os.listdir(): os.mkdir('{basename}')"
-                logger.debug(f"Creating: {basename}")
-
-            self.send(cmd)
-            self.dirs_created += 1
+            logger.debug(f"Creating: {', '.join(dir_paths)}")
+            self.send(
+                f"for p in {dir_paths!r}:\n"
+                f" try:os.mkdir(p)\n"
+                f" except OSError:pass"
+            )
+            self.dirs_created += len(dir_paths)
         except Exception as e:
-            logger.warning(f"Could not create directory {dir_path}: {e}")
+            logger.warning(f"Could not create directories: {e}")
+
+    def _iter_files(self, path: Optional[str] = None) -> Iterator[os.DirEntry]:
+        """Yield files to upload, directory by directory in sorted order.
+
+        Args:
+            path: Directory to scan (None = upload root)
+
+        Returns:
+            Iterator over directory entries of the files to upload
+        """
+        with os.scandir(path or self._root_str) as it:
+            entries = sorted(it, key=attrgetter('name'))
+
+        subdirs = []
+        for entry in entries:
+            if entry.name in self.excludes:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file() and (not self.includes or entry.name in self.includes):
+                yield entry
+
+        for subdir in subdirs:
+            yield from self._iter_files(subdir)
 
     def upload(self) -> bool:
         """Main upload process.
@@ -359,7 +821,6 @@ class Uploader:
             logger.info("MicroPython File Uploader")
             logger.info("=" * 60)
             logger.info(f"Local root: {self.file_system_dir}")
-            logger.info(f"Temp dir: {self.temp_dir}")
             logger.info(f"Excludes: {self.excludes}")
             logger.info(f"Includes: {self.includes}")
             logger.info(f"Smash level: {self.smash_level}")
@@ -370,43 +831,47 @@ class Uploader:
             if not self.dry_run:
                 self._validate_port()
                 self._connect()
-                self.send("import os")
-
-            # Walk file system
-            for root, dirs, files in os.walk(self.file_system_dir):
-                # Filter directories
-                dirs[:] = [
-                    d for d in dirs
-                    if d not in self.excludes
-                ]
-                dirs.sort()
-
-                # Filter files
-                filtered_files = [
-                    f for f in files
-                    if f not in self.excludes and
-                       (not self.includes or f in self.includes)
-                ]
-                filtered_files.sort()
-
-                # Create directories
-                for d in filtered_files:
-                    root_path = Path(root)
-                    rel_path = root_path.relative_to(self.file_system_dir)
-                    remote_dir = str(rel_path).replace('\\', '/')
-                    if remote_dir != '.':
-                        self._create_directory(remote_dir)
-
-                # Upload files
-                for f in filtered_files:
-                    local_file = Path(root) / f
-                    rel_path = local_file.relative_to(self.file_system_dir)
-                    remote_file = str(rel_path).replace('\\', '/')
-                    self._upload_file(local_file, remote_file)
+                self.send(self.DEVICE_SETUP)
+
+            # Walk file system, preparing files in the background
+            uploads: Deque[Tuple[Path, str, Future]] = deque()
+            remote_dirs: Set[str] = set()
+            with ThreadPoolExecutor(max_workers=self.PREPARE_WORKERS) as pool:
+                root = None
+                remote_dir = ''
+                for entry in self._iter_files():
+                    # Files arrive grouped by directory
+                    entry_root = os.path.dirname(entry.path)
+                    if entry_root != root:
+                        root = entry_root
+                        remote_dir = root[len(self._root_str):].replace(os.sep, '/')
+
+                        # Directory and all its parents are needed on device
+                        parent = remote_dir
+                        while parent and parent not in remote_dirs:
+                            remote_dirs.add(parent)
+                            parent = parent.rpartition('/')[0]
+
+                    # Queue file for preparation
+                    local_file = Path(entry.path)
+                    remote_file = f"{remote_dir}/{entry.name}" if remote_dir else entry.name
+                    future = pool.submit(self._prepare_file, local_file)
+                    uploads.append((local_file, remote_file, future))
+
+                # Sorting puts parents before their children
+                self._create_directories(sorted(remote_dirs))
+
+                # Upload files in walk order; serial I/O stays on this thread.
+                # Popping drops each prepared buffer once it is sent
+                while uploads:
+                    self._upload_file(*uploads.popleft())
 
             logger.info("=" * 60)
             logger.info(f"Upload complete!")
-            logger.info(f"Files: {self.files_uploaded}, Directories: {self.dirs_created}")
+            logger.info(
+                f"Files: {self.files_uploaded}, Unchanged: {self.files_skipped}, "
+                f"Directories: {self.dirs_created}"
+            )
             logger.info(f"Bytes sent: {self.bytes_sent}")
             logger.info("=" * 60)
 
@@ -418,15 +883,6 @@ class Uploader:
 
         finally:
             self._disconnect()
-            self._cleanup_temp()
-
-    def _cleanup_temp(self) -> None:
-        """Remove temporary files."""
-        try:
-            for f in self.temp_dir.glob("smash_*"):
-                f.unlink()
-        except Exception as e:
-            logger.warning(f"Could not clean temp files: {e}")
 
 
 def main():
@@ -465,6 +921,12 @@ def main():
         default=2,
         help='Smash level (1=blank, 2=comments, 3=inline)'
     )
+    parser.add_argument(
+        '--baud',
+        type=int,
+        default=921600,
+        help='Baud rate to switch to after connecting (default: 921600)'
+    )
     parser.add_argument(
         '-n', '--dry-run',
         action='store_true',
@@ -487,7 +949,8 @@ def main():
             smash=not args.no_smash,
             smash_level=args.smash_level,
             dry_run=args.dry_run,
-            verbose=args.verbose
+            verbose=args.verbose,
+            baudrate=args.baud
         )
         success = uploader.upload()
         sys.exit(0 if success else 1)
@@ -2,8 +2,7 @@ import time
 import threading
 import serial
 import logging
-from typing import Callable, Optional
-from queue import Queue, Empty
+from typing import Callable, List, Optional, Tuple, Union
 
 # Configure logging
 logger = logging.getLogger(__name__)
@@ -13,26 +12,42 @@ class PySignal:
     """Simple signal/slot mechanism for event handling"""
 
     def __init__(self):
-        self.slots = []
+        # Replaced, never mutated, so emit() can iterate while slots change
+        self.slots: Tuple[Callable, ...] = ()
 
     def connect(self, callback: Callable) -> None:
         """Connect callback to signal"""
         if callback not in self.slots:
-            self.slots.append(callback)
+            self.slots = self.slots + (callback,)
 
     def disconnect(self, callback: Callable) -> None:
         """Disconnect callback from signal"""
         if callback in self.slots:
-            self.slots.remove(callback)
+            self.slots = tuple(slot for slot in self.slots if slot != callback)
 
     def emit(self, *args, **kwargs) -> None:
         """Emit signal to all connected slots"""
-        for callback in self.slots:
+        slots = self.slots
+        if not slots:
+            return
+        for callback in slots:
             try:
                 callback(*args, **kwargs)
             except Exception as e:
                 logger.error(f"Error in signal handler: {e}")
 
+    def emit_many(self, items: List) -> None:
+        """Emit signal once per item, calling each slot for all items in turn"""
+        slots = self.slots
+        if not slots or not items:
+            return
+        for callback in slots:
+            for item in items:
+                try:
+                    callback(item)
+                except Exception as e:
+                    logger.error(f"Error in signal handler: {e}")
+
 
 class SerialConnectionException(Exception):
     """Serial connection specific errors"""
@@ -55,6 +70,10 @@ class SerialConnectionWrapper:
     disconnected = PySignal()
     error = PySignal()
 
+    # Fixed commands, pre-encoded
+    RESET_COMMAND = b"import machine\rmachine.reset()\r"
+    RESET_TIMEOUT = 3.0  # Max time for the device to boot back to the prompt
+
     def __init__(
             self,
             port: str = "COM3",
@@ -62,7 +81,8 @@ class SerialConnectionWrapper:
             timeout: float = 0.1,
             auto_reset: bool = False,
             recv_buffer_size: int = 1024,
-            recv_timeout: float = 1.0
+            recv_timeout: float = 1.0,
+            write_timeout: float = 1.0
     ):
         """Initialize serial connection wrapper.
 
@@ -71,8 +91,9 @@ class SerialConnectionWrapper:
             baudrate: Baud rate for connection
             timeout: Serial read timeout in seconds
             auto_reset: Automatically reset device on connection
-            recv_buffer_size: Size of receive buffer chunks
+            recv_buffer_size: Max bytes drained per read after the first byte
             recv_timeout: Timeout for receive thread operations
+            write_timeout: Timeout for a single write in seconds
         """
         self.port = port
         self.baudrate = baudrate
@@ -80,13 +101,12 @@ class SerialConnectionWrapper:
         self.auto_reset = auto_reset
         self.recv_buffer_size = recv_buffer_size
         self.recv_timeout = recv_timeout
+        self.write_timeout = write_timeout
 
         self.connection: Optional[serial.Serial] = None
         self.recv_thread: Optional[threading.Thread] = None
         self.stop_signal = False
-        self.recv_lock = threading.Lock()
         self.send_lock = threading.Lock()
-        self.recv_queue: Queue = Queue()
         self.connected_flag = False
 
         logger.info(f"SerialConnectionWrapper initialized: {port} @ {baudrate} baud")
@@ -104,6 +124,7 @@ class SerialConnectionWrapper:
                 port=self.port,
                 baudrate=self.baudrate,
                 timeout=self.timeout,
+                write_timeout=self.write_timeout,
                 parity=serial.PARITY_NONE,
                 stopbits=serial.STOPBITS_ONE,
                 bytesize=serial.EIGHTBITS
@@ -131,9 +152,7 @@ class SerialConnectionWrapper:
             # Optional: reset device
             if self.auto_reset:
                 logger.info("Auto-resetting device...")
-                self.send("import machine\r", timeout=0.5)
-                self.send("machine.reset()\r", timeout=2)
-                time.sleep(1)
+                self._reset_device()
 
             return True
 
@@ -170,12 +189,13 @@ class SerialConnectionWrapper:
         except Exception as e:
             logger.error(f"Error during disconnect: {e}")
 
-    def send(self, data: str, timeout: float = 0.1) -> bool:
+    def send(self, data: Union[str, bytes], timeout: float = 0.1, flush: bool = False) -> bool:
         """Send data to device via serial connection.
 
         Args:
-            data: String to send to device
+            data: String (sent UTF-8 encoded) or bytes to send to device
             timeout: Time to wait after sending
+            flush: Block until the data has left the OS transmit buffer
 
         Returns:
             True if successful, False otherwise
@@ -188,14 +208,15 @@ class SerialConnectionWrapper:
             with self.send_lock:
                 # Convert string to bytes
                 if isinstance(data, str):
-                    data_bytes = [ord(x) for x in data]
+                    data_bytes = data.encode('utf-8')
                 else:
                     data_bytes = data
 
                 self.connection.write(data_bytes)
-                self.connection.flush()
+                if flush:
+                    self.connection.flush()
 
-                logger.debug(f"Sent: {repr(data[:50])}")
+                logger.debug("Sent: %r", data[:50])
 
             # Optional wait after sending
             if timeout > 0:
@@ -212,38 +233,123 @@ class SerialConnectionWrapper:
             self.error.emit(f"Unexpected send error: {e}")
             return False
 
+    def send_many(self, lines: List[str], timeout: float = 0.1) -> bool:
+        """Send several REPL lines with a single write.
+
+        Args:
+            lines: Lines to send, without line endings
+            timeout: Time to wait after sending
+
+        Returns:
+            True if successful, False otherwise
+        """
+        return self.send(''.join(line + '\r' for line in lines), timeout)
+
+    def wait_for(
+            self,
+            text: str,
+            data: Optional[Union[str, bytes]] = None,
+            timeout: float = 1.0
+    ) -> Optional[str]:
+        """Wait for a received line containing text.
+
+        Args:
+            text: Text to look for in received lines
+            data: Optional data to send once listening
+            timeout: Max time to wait in seconds
+
+        Returns:
+            First matching line, or None on timeout
+        """
+        return self._wait_line(lambda line: text in line, data, timeout)
+
+    def _reset_device(self) -> bool:
+        """Reset device and wait until it is back at the REPL prompt.
+
+        Returns:
+            True if the prompt appeared, False on timeout
+        """
+        prompt = self._wait_line(lambda line: line == '>>>', self.RESET_COMMAND, self.RESET_TIMEOUT)
+        if prompt is None:
+            logger.warning("No prompt from device after reset")
+            return False
+        return True
+
+    def _wait_line(
+            self,
+            match: Callable[[str], bool],
+            data: Optional[Union[str, bytes]],
+            timeout: float
+    ) -> Optional[str]:
+        """Send data and wait for a received line accepted by match.
+
+        The handler is connected before sending, so a fast reply can't be missed.
+
+        Returns:
+            First matching line, or None on timeout
+        """
+        found: List[str] = []
+        event = threading.Event()
+
+        def on_line(line: str) -> None:
+            if not event.is_set() and match(line):
+                found.append(line)
+                event.set()
+
+        self.recv_data.connect(on_line)
+        try:
+            if data is not None and not self.send(data, timeout=0):
+                return None
+            event.wait(timeout)
+            return found[0] if found else None
+        finally:
+            self.recv_data.disconnect(on_line)
+
     def _recv_worker(self) -> None:
         """Worker thread for receiving data from device.
 
         Runs in background thread and emits signals when data received.
         """
         logger.info("Receive thread started")
+        # Bytes of the line still being received
+        rbuffer = bytearray()
 
         try:
             while not self.stop_signal:
                 try:
-                    with self.recv_lock:
-                        if not self.connection or not self.connection.is_open:
-                            break
+                    if not self.connection or not self.connection.is_open:
+                        break
 
-                        data = self.connection.read(self.recv_buffer_size)
+                    # Block until data arrives (or timeout), then drain the rest
+                    data = self.connection.read(1)
+                    if data:
+                        data += self.connection.read(
+                            min(self.connection.in_waiting, self.recv_buffer_size)
+                        )
 
                     if data:
+                        rbuffer.extend(data)
+                        end = rbuffer.rfind(b'\n') + 1
+                    else:
+                        # Line went quiet, pass on unterminated text (prompt)
+                        end = len(rbuffer)
+
+                    if end:
                         try:
-                            decoded = data.decode('utf-8', errors='replace')
+                            decoded = rbuffer[:end].decode('utf-8', errors='replace')
+                            del rbuffer[:end]
 
                             # Process each line
-                            for line in decoded.split('\n'):
-                                line = line.strip('\r').strip()
-                                if line:
-                                    logger.debug(f"Received: {repr(line)}")
-                                    self.recv_data.emit(line)
+                            lines = [line.strip() for line in decoded.splitlines()]
+                            lines = [line for line in lines if line]
+                            if logger.isEnabledFor(logging.DEBUG):
+                                for line in lines:
+                                    logger.debug("Received: %r", line)
+                            self.recv_data.emit_many(lines)
 
                         except Exception as e:
                             logger.warning(f"Error decoding data: {e}")
 
-                    time.sleep(0.01)  # Small delay to prevent CPU spinning
-
                 except serial.SerialException as e:
                     logger.error(f"Serial error in receive thread: {e}")
                     self.error.emit(f"Receive error: {e}")